@@ -17,3 +17,7 @@ logging.basicConfig(level=_log_level,
                     format=WHITE + "%(asctime)s.%(msecs)03d [%(name)s] "
                                    "%(levelname)s: %(message)s",
                     datefmt='%Y-%m-%d %H:%M:%S')
+
+# httpx logs every request URL at INFO, and firehose URLs carry the
+# firehose token, so only surface its warnings.
+logging.getLogger("httpx").setLevel(logging.WARNING)
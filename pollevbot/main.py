@@ -1,8 +1,9 @@
 import json
+import os
 import textwrap
 from getpass import getpass
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Tuple
 import sys
 
 try:
@@ -17,6 +18,12 @@ except ModuleNotFoundError:
 COOKIE_PATH = Path("session_cookies.json")
 HOST_PATH = Path("last_host.txt")
 TOKEN_PATH = Path("firehose_tokens.json")
+SEQUENCE_PATH = Path("firehose_seq.json")
+
+# Parsed cache files keyed by (path, mtime) so repeated reads within a
+# process skip the disk and JSON decode until the file changes.
+_TOKEN_CACHE: Dict[Tuple[str, float], dict] = {}
+_COOKIE_CACHE: Dict[Tuple[str, float], dict] = {}
 
 
 def prompt(text: str, default: Optional[str] = None) -> str:
@@ -31,12 +38,10 @@ def prompt(text: str, default: Optional[str] = None) -> str:
 
 def parse_cookie_string(raw: str) -> dict:
     cookies = {}
-    segments = [segment.strip() for segment in raw.split(';') if segment.strip()]
-    for segment in segments:
-        if '=' not in segment:
-            continue
-        key, value = segment.split('=', 1)
-        cookies[key.strip()] = value.strip()
+    for segment in raw.split(';'):
+        key, sep, value = segment.partition('=')
+        if sep:
+            cookies[key.strip()] = value.strip()
     return cookies
 
 
@@ -70,10 +75,19 @@ def prompt_for_cookies(path: Path) -> dict:
                 continue
         with path.open("w") as fh:
             json.dump(cookies, fh, indent=2)
+        _COOKIE_CACHE.clear()
         print(f"Saved session cookies to {path.resolve()}")
         return cookies
 
 
+def read_saved_cookies(path: Path) -> dict:
+    key = (str(path), path.stat().st_mtime)
+    if key not in _COOKIE_CACHE:
+        with path.open() as fh:
+            _COOKIE_CACHE[key] = json.load(fh)
+    return dict(_COOKIE_CACHE[key])
+
+
 def load_cookies(path: Path) -> dict:
     if not path.exists():
         return prompt_for_cookies(path)
@@ -81,8 +95,7 @@ def load_cookies(path: Path) -> dict:
     use_saved = input(f"Found saved session cookies at {path}. Use them? [Y/n]: ").strip().lower()
     if use_saved in {"", "y", "yes"}:
         try:
-            with path.open() as fh:
-                cookies = json.load(fh)
+            cookies = read_saved_cookies(path)
         except json.JSONDecodeError:
             print("Could not read the saved cookie file. We'll capture new cookies.")
             cookies = prompt_for_cookies(path)
@@ -92,8 +105,12 @@ def load_cookies(path: Path) -> dict:
 
 
 def load_token_cache(path: Path) -> dict:
-    if not path.exists():
+    try:
+        key = (str(path), path.stat().st_mtime)
+    except FileNotFoundError:
         return {}
+    if key in _TOKEN_CACHE:
+        return dict(_TOKEN_CACHE[key])
     try:
         with path.open() as fh:
             data = json.load(fh)
@@ -105,14 +122,22 @@ def load_token_cache(path: Path) -> dict:
         if len(filtered) != len(data):
             print("Warning: firehose token cache included non-string entries. "
                   "Those entries were ignored.")
-        return filtered
+        _TOKEN_CACHE[key] = filtered
+        return dict(filtered)
     print("Warning: firehose token cache format was unexpected. Ignoring it.")
     return {}
 
 
 def save_token_cache(path: Path, cache: dict) -> None:
+    _TOKEN_CACHE.clear()
+    data = json.dumps(cache, indent=2, sort_keys=True).encode("utf-8")
     try:
-        path.write_text(json.dumps(cache, indent=2, sort_keys=True), encoding="utf-8")
+        if path.exists() and path.read_bytes() == data:
+            return
+        # Write to a temporary file first so a crash can't truncate the cache.
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
     except OSError as exc:
         print(f"Warning: could not save firehose token cache ({exc}).")
 
@@ -192,6 +217,8 @@ def main():
 
     firehose_token = prompt_for_firehose_token(host, TOKEN_PATH)
     config["firehose_token"] = firehose_token
+    config["initial_sequence"] = PollBot.load_sequence(SEQUENCE_PATH, host)
+    config["sequence_path"] = SEQUENCE_PATH
 
     with PollBot(**config) as bot:
         bot.run()
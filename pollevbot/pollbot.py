@@ -1,12 +1,65 @@
-import requests
+import html
+import httpx
 import logging
+import orjson
+import os
+import random
+import re
 import time
-from typing import Optional, Dict
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Dict, Tuple, Union
+from uuid import uuid4
 from .endpoints import endpoints
 
 logger = logging.getLogger(__name__)
 __all__ = ['PollBot']
 
+# Seconds a fetched CSRF token is reused before being refreshed.
+CSRF_TOKEN_TTL = 300
+# Status codes PollEv returns when a POST's CSRF token is rejected.
+CSRF_REJECTED_STATUSES = {401, 403}
+# Number of handled firehose sequence advances between writes to `sequence_path`.
+SEQUENCE_SAVE_INTERVAL = 10
+# Upper bound in seconds on the sleep between empty firehose responses.
+MAX_IDLE_BACKOFF = 1.0
+# Number of polls whose data is kept in memory by answer_poll.
+POLL_CACHE_SIZE = 32
+# Seconds cached poll data is reused before it is fetched again.
+POLL_CACHE_TTL = 30
+
+# The MyUW SAML pages are machine-generated, so the few attributes we need
+# are pulled out with regexes rather than by building a full DOM.
+_LOGIN_FORM_RE = re.compile(rb'<form\b[^>]*\bid="idplogindiv"[^>]*>')
+_HIDDEN_INPUT_RE = re.compile(rb'<input\b[^>]*\btype="hidden"[^>]*>')
+_ACTION_RE = re.compile(rb'\baction="([^"]*)"')
+_VALUE_RE = re.compile(rb'\bvalue="([^"]*)"')
+
+
+def _find_attribute(content: bytes, tag_re, attr_re) -> Optional[str]:
+    """
+    Returns the (unescaped) attribute matched by `attr_re` on the first
+    tag in `content` matched by `tag_re`, or None if either is missing.
+    """
+    tag = tag_re.search(content)
+    if not tag:
+        return None
+    attr = attr_re.search(tag.group(0))
+    if not attr:
+        return None
+    return html.unescape(attr.group(1).decode())
+
+
+def _partial_format(template: str, **fields) -> str:
+    """
+    Substitutes `fields` into `template` ahead of time, leaving every other
+    placeholder intact so the result can still be used with str.format.
+    """
+    for name, value in fields.items():
+        escaped = str(value).replace('{', '{{').replace('}', '}}')
+        template = template.replace('{' + name + '}', escaped)
+    return template
+
 
 class LoginError(RuntimeError):
     """Error indicating that login failed."""
@@ -29,7 +82,9 @@ class PollBot:
                  max_option: int = None, closed_wait: float = 5,
                  open_wait: float = 5, lifetime: float = float('inf'),
                  session_cookies: Optional[Dict[str, str]] = None,
-                 firehose_token: Optional[str] = None):
+                 firehose_token: Optional[str] = None,
+                 initial_sequence: int = 0,
+                 sequence_path: Optional[Union[str, Path]] = None):
         """
         Constructor. Creates a PollBot that answers polls on pollev.com.
 
@@ -50,6 +105,11 @@ class PollBot:
         :param session_cookies: Optional mapping of cookie name to value used to
                         authenticate without performing a login.
         :param firehose_token: Optional AWS firehose token to poll for activity.
+        :param initial_sequence: Firehose message sequence to resume from,
+                        i.e. the last sequence seen by a previous run.
+        :param sequence_path: Optional JSON file mapping host to the latest
+                        firehose sequence. If given, the sequence is saved
+                        there periodically and when the bot exits.
         :raises ValueError: if login_type is not 'uw' or 'pollev'.
         """
         if login_type not in {'uw', 'pollev'}:
@@ -76,30 +136,130 @@ class PollBot:
         self.start_time = time.time()
         self.session_cookies = session_cookies or {}
         self.firehose_token = firehose_token
-        self.last_message_sequence = 0
-
-        self.session = requests.Session()
-        self.session.headers = {
-            'user-agent': "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-                          "(KHTML, like Gecko) Chrome/70.0.3538.102 Safari/537.36"
+        self.initial_sequence = initial_sequence
+        self.last_message_sequence = initial_sequence
+        self.sequence_path = Path(sequence_path) if sequence_path else None
+        # Latest sequence whose message has been fully handled (answered or
+        # idle). Only this is persisted, so a restart never skips an open poll.
+        self._handled_sequence = initial_sequence
+        self._unsaved_sequence_updates = 0
+        # Delay between empty firehose responses. The long-poll already paces
+        # requests, so this starts at 0 and grows up to MAX_IDLE_BACKOFF
+        # while nothing happens.
+        self._backoff = 0.0
+        # poll_id -> (fetch time, poll data), least recently used first. Poll
+        # options rarely change, so retries shortly after can skip re-fetching.
+        self._poll_cache: 'OrderedDict[str, Tuple[float, dict]]' = OrderedDict()
+        # The host is fixed for the session, so specialize its URL templates once.
+        self._home_url = endpoints['home'].format(host=host)
+        self._firehose_auth_fmt = _partial_format(endpoints['firehose_auth'], host=host)
+        self._firehose_no_token_fmt = _partial_format(endpoints['firehose_no_token'], host=host)
+        self._firehose_url_fmt: Optional[str] = None
+        # CSRF tokens are valid for the life of the session, so they are
+        # cached and only refreshed after expiry or a rejected POST.
+        self._csrf_token: Optional[str] = None
+        self._csrf_expiry: float = 0
+        # Before issuing a token, AWS checks for two visitor cookies that
+        # PollEverywhere generates using js. They are random uuids, created
+        # once so every firehose auth attempt presents the same visitor.
+        self._visitor_cookies = {
+            'pollev_visitor': str(uuid4()),
+            'pollev_visit': str(uuid4())
         }
 
-    def _update_last_message_sequence(self, sequence) -> None:
-        """Track the latest firehose message sequence observed."""
-        if sequence is None:
+        # A single HTTP/2 client multiplexes the firehose long-poll and API
+        # requests over one TLS connection for the lifetime of the bot.
+        self.session = httpx.Client(
+            http2=True,
+            follow_redirects=True,
+            headers={
+                'user-agent': "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                              "(KHTML, like Gecko) Chrome/70.0.3538.102 Safari/537.36"
+            },
+            timeout=httpx.Timeout(25.0, connect=5.0)
+        )
+
+    def _update_last_message_sequence(self, *sequences) -> None:
+        """Track the latest firehose message sequence among `sequences`."""
+        best = self.last_message_sequence
+        for sequence in sequences:
+            # Firehose sends ints, so skip int() coercion on the common path.
+            if isinstance(sequence, int):
+                seq_int = sequence
+            elif sequence is None:
+                continue
+            else:
+                try:
+                    seq_int = int(sequence)
+                except (TypeError, ValueError):
+                    logger.debug("firehose sequence value not an int; value=%s", sequence)
+                    continue
+            if seq_int > best:
+                best = seq_int
+        if best > self.last_message_sequence:
+            self.last_message_sequence = best
+
+    def _mark_sequence_handled(self) -> None:
+        """
+        Marks every firehose message up to `last_message_sequence` as handled,
+        saving it to `sequence_path` every SEQUENCE_SAVE_INTERVAL advances.
+        """
+        if self.last_message_sequence > self._handled_sequence:
+            self._handled_sequence = self.last_message_sequence
+            self._unsaved_sequence_updates += 1
+            if self._unsaved_sequence_updates >= SEQUENCE_SAVE_INTERVAL:
+                self.save_sequence()
+
+    @staticmethod
+    def _read_sequences(path: Path) -> dict:
+        """Reads the host -> sequence mapping at `path`, or {} if missing."""
+        try:
+            sequences = orjson.loads(path.read_bytes())
+        except FileNotFoundError:
+            return {}
+        except (OSError, orjson.JSONDecodeError) as exc:
+            logger.warning("could not read firehose sequences from %s: %s", path, exc)
+            return {}
+        return sequences if isinstance(sequences, dict) else {}
+
+    @staticmethod
+    def load_sequence(path: Union[str, Path], host: str) -> int:
+        """
+        Returns the firehose sequence saved for `host` by `save_sequence`,
+        or 0 if none was saved.
+        """
+        sequence = PollBot._read_sequences(Path(path)).get(host, 0)
+        return sequence if isinstance(sequence, int) else 0
+
+    def save_sequence(self) -> None:
+        """
+        Atomically records the latest handled firehose sequence for this
+        host in `sequence_path` so a restarted bot can resume from it.
+        """
+        if self.sequence_path is None:
             return
+        path = self.sequence_path
+        sequences = self._read_sequences(path)
+        sequences[self.host] = self._handled_sequence
+        tmp = path.with_suffix(path.suffix + '.tmp')
         try:
-            seq_int = int(sequence)
-        except (TypeError, ValueError):
-            logger.debug("firehose sequence value not an int; value=%s", sequence)
+            tmp.write_bytes(orjson.dumps(sequences,
+                                         option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+            os.replace(tmp, path)
+        except OSError as exc:
+            logger.warning("could not save firehose sequence to %s: %s", path, exc)
             return
-        if seq_int > self.last_message_sequence:
-            self.last_message_sequence = seq_int
+        self._unsaved_sequence_updates = 0
 
     def __enter__(self):
         return self
 
-    def __exit__(self, *args):
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Don't persist after a failure. Ctrl+C is the normal way to stop the
+        # bot, and only handled sequences are ever saved, so it still saves.
+        clean_exit = exc_type is None or issubclass(exc_type, KeyboardInterrupt)
+        if clean_exit and self._unsaved_sequence_updates:
+            self.save_sequence()
         self.session.close()
 
     @staticmethod
@@ -107,8 +267,37 @@ class PollBot:
         return round(time.time() * 1000)
 
     def _get_csrf_token(self) -> str:
+        if self._csrf_token and time.time() < self._csrf_expiry:
+            return self._csrf_token
         url = endpoints['csrf'].format(timestamp=self.timestamp())
-        return self.session.get(url).json()['token']
+        self._csrf_token = orjson.loads(self.session.get(url).content)['token']
+        self._csrf_expiry = time.time() + CSRF_TOKEN_TTL
+        return self._csrf_token
+
+    def _invalidate_csrf(self) -> None:
+        """Forget the cached CSRF token so the next request fetches a new one."""
+        self._csrf_token = None
+        self._csrf_expiry = 0
+
+    def _csrf_post(self, url: str, **kwargs) -> httpx.Response:
+        """
+        POSTs to `url` with the cached CSRF token. If a cached token is
+        rejected, fetches a fresh one and retries once. A token fetched for
+        this call is not retried, since its rejection can't be staleness.
+        Returns the last response.
+        """
+        cached = self._csrf_token is not None and time.time() < self._csrf_expiry
+        r = self.session.post(url, headers={'x-csrf-token': self._get_csrf_token()}, **kwargs)
+        if r.status_code in CSRF_REJECTED_STATUSES and not cached:
+            self._invalidate_csrf()
+        elif r.status_code in CSRF_REJECTED_STATUSES:
+            logger.debug("CSRF token rejected by %s (status=%s); retrying with a fresh token",
+                         url, r.status_code)
+            self._invalidate_csrf()
+            r = self.session.post(url, headers={'x-csrf-token': self._get_csrf_token()}, **kwargs)
+            if r.status_code in CSRF_REJECTED_STATUSES:
+                self._invalidate_csrf()
+        return r
 
     def _pollev_login(self) -> bool:
         """
@@ -117,25 +306,25 @@ class PollBot:
         """
         logger.info("Logging into PollEv through pollev.com.")
 
+        # A 401/403 here means bad credentials, so never re-send them.
         r = self.session.post(endpoints['login'],
                               headers={'x-csrf-token': self._get_csrf_token()},
                               data={'login': self.user, 'password': self.password})
         # If login is successful, PollEv sends an empty HTTP response.
-        return not r.text
+        return not r.content
 
     def _uw_login(self):
         """
         Logs into PollEv through MyUW.
         Returns True on success, False otherwise.
         """
-        import bs4 as bs
-        import re
-
         logger.info("Logging into PollEv through MyUW.")
 
         r = self.session.get(endpoints['uw_saml'])
-        soup = bs.BeautifulSoup(r.text, "html.parser")
-        data = soup.find('form', id='idplogindiv')['action']
+        data = _find_attribute(r.content, _LOGIN_FORM_RE, _ACTION_RE)
+        if data is None:
+            logger.error("MyUW login page did not contain the expected login form.")
+            return False
         session_id = re.findall(r'jsessionid=(.*)\.', data)
 
         r = self.session.post(endpoints['uw_login'].format(id=session_id),
@@ -144,24 +333,24 @@ class PollBot:
                                   'j_password': self.password,
                                   '_eventId_proceed': 'Sign in'
                               })
-        soup = bs.BeautifulSoup(r.text, "html.parser")
-        saml_response = soup.find('input', type='hidden')
+        saml_response = _find_attribute(r.content, _HIDDEN_INPUT_RE, _VALUE_RE)
 
         # When user authentication fails, UW will send an empty SAML response.
         if not saml_response:
             return False
 
         r = self.session.post(endpoints['uw_callback'],
-                              data={'SAMLResponse': saml_response['value']})
-        auth_tokens = re.findall('pe_auth_token=(.*)', r.url)
+                              data={'SAMLResponse': saml_response})
+        auth_tokens = re.findall('pe_auth_token=(.*)', str(r.url))
         if not auth_tokens:
             logger.error("MyUW login returned without an auth token. "
                          "Check your credentials or login_type.")
             return False
         auth_token = auth_tokens[0]
-        self.session.post(endpoints['uw_auth_token'],
-                          headers={'x-csrf-token': self._get_csrf_token()},
-                          data={'token': auth_token})
+        r = self._csrf_post(endpoints['uw_auth_token'], data={'token': auth_token})
+        if r.status_code in CSRF_REJECTED_STATUSES:
+            logger.error("PollEv rejected the MyUW auth token (status=%s).", r.status_code)
+            return False
         return True
 
     def login(self):
@@ -176,6 +365,8 @@ class PollBot:
             success = self._pollev_login()
         if not success:
             raise LoginError("Your username or password was incorrect.")
+        # Logging in starts a new server-side session; don't reuse its old token.
+        self._invalidate_csrf()
         logger.info("Login successful.")
 
     def get_firehose_token(self) -> str:
@@ -186,69 +377,62 @@ class PollBot:
 
         :raises ValueError: if the specified poll host is not found.
         """
-        from uuid import uuid4
-        # Before issuing a token, AWS checks for two visitor cookies that
-        # PollEverywhere generates using js. They are random uuids.
-        self.session.cookies['pollev_visitor'] = str(uuid4())
-        self.session.cookies['pollev_visit'] = str(uuid4())
-        url = endpoints['firehose_auth'].format(
-            host=self.host,
-            timestamp=self.timestamp()
-        )
+        self.session.cookies.update(self._visitor_cookies)
+        url = self._firehose_auth_fmt.format(timestamp=self.timestamp())
         r = self.session.get(url)
-        logger.debug("firehose auth status=%s body=%s", r.status_code, r.text[:512])
+        logger.debug("firehose auth status=%s body=%s",
+                     r.status_code, r.content[:512].decode('utf-8', 'replace'))
 
-        if "presenter not found" in r.text.lower():
+        if b"presenter not found" in r.content.lower():
             raise ValueError(f"'{self.host}' is not a valid poll host.")
-        token = r.json().get('firehose_token')
+        token = orjson.loads(r.content).get('firehose_token')
         logger.debug("firehose auth token=%s", token)
         return token
 
     def get_new_poll_id(self, firehose_token=None) -> Optional[str]:
-        import json
-
         if firehose_token:
-            url = endpoints['firehose_with_token'].format(
-                host=self.host,
-                token=firehose_token,
-                sequence=self.last_message_sequence,
-                timestamp=self.timestamp()
-            )
+            if firehose_token == self.firehose_token and self._firehose_url_fmt:
+                url_fmt = self._firehose_url_fmt
+            else:
+                url_fmt = _partial_format(endpoints['firehose_with_token'],
+                                          host=self.host, token=firehose_token)
         else:
-            url = endpoints['firehose_no_token'].format(
-                host=self.host,
-                sequence=self.last_message_sequence,
-                timestamp=self.timestamp()
-            )
+            url_fmt = self._firehose_no_token_fmt
+        url = url_fmt.format(sequence=self.last_message_sequence,
+                             timestamp=self.timestamp())
         response_json = {}
         message = ''
         try:
             logger.debug("firehose request → %s", url)
             r = self.session.get(url, timeout=25)
-            logger.debug("firehose status=%s cookies=%s", r.status_code, r.cookies.get_dict())
-            logger.debug("firehose body=%s", r.text[:512])
-            response_json = r.json()
-            self._update_last_message_sequence(response_json.get('last_message_sequence'))
+            logger.debug("firehose status=%s cookies=%s", r.status_code, dict(r.cookies))
+            logger.debug("firehose body=%s", r.content[:512].decode('utf-8', 'replace'))
+            response_json = orjson.loads(r.content)
             message = response_json.get('message', '')
+            payload_json = orjson.loads(message) if message else None
+            poll_id = payload_json.get('uid') if isinstance(payload_json, dict) else None
+            # Advance past both the response and message sequences in one update.
+            self._update_last_message_sequence(
+                response_json.get('last_message_sequence'),
+                payload_json.get('sequence') if poll_id else None
+            )
             if not message:
                 logger.debug("firehose response missing message payload; raw json=%s", response_json)
                 return None
-            payload_json = json.loads(message)
             if not isinstance(payload_json, dict):
                 logger.debug("firehose message payload not a dict; payload=%s raw json=%s",
                              payload_json, response_json)
                 return None
-            poll_id = payload_json.get('uid')
             if not poll_id:
                 logger.debug("firehose message missing UID payload; message=%s raw json=%s",
                              message, response_json)
                 return None
-            self._update_last_message_sequence(payload_json.get('sequence'))
         # Firehose either doesn't respond or responds with no data if no poll is open.
-        except requests.exceptions.ReadTimeout:
+        except httpx.ReadTimeout:
             logger.debug("firehose long-poll timed out (no new activity yet); will retry")
             return None
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
+            self._update_last_message_sequence(response_json.get('last_message_sequence'))
             logger.debug("firehose message payload was not valid JSON; message=%s raw json=%s",
                          message, response_json)
             return None
@@ -256,33 +440,52 @@ class PollBot:
         return poll_id
 
     def answer_poll(self, poll_id) -> dict:
-        import random
-
-        url = endpoints['poll_data'].format(uid=poll_id)
-        poll_data = self.session.get(url).json()
+        cached = self._poll_cache.get(poll_id)
+        if cached and time.time() < cached[0] + POLL_CACHE_TTL:
+            poll_data = cached[1]
+            self._poll_cache.move_to_end(poll_id)
+        else:
+            url = endpoints['poll_data'].format(uid=poll_id)
+            poll_data = orjson.loads(self.session.get(url).content)
+            self._poll_cache[poll_id] = (time.time(), poll_data)
+            self._poll_cache.move_to_end(poll_id)
+            if len(self._poll_cache) > POLL_CACHE_SIZE:
+                self._poll_cache.popitem(last=False)
         logger.debug("poll %s data keys=%s", poll_id, list(poll_data.keys()))
-        options = poll_data['options'][self.min_option:self.max_option]
+        options = poll_data['options']
+        # Slicing a range gives the valid indices without copying `options`.
+        indices = range(len(options))[self.min_option:self.max_option]
         logger.debug("poll %s options slice [%s:%s] -> %s choices",
                      poll_id, self.min_option, self.max_option,
-                     len(options))
-        try:
-            option_id = random.choice(options)['id']
-        except IndexError:
-            # `options` was empty
+                     len(indices))
+        if not indices:
             logger.error(f'Could not answer poll: poll only has '
-                         f'{len(poll_data["options"])} options but '
+                         f'{len(options)} options but '
                          f'self.min_option was {self.min_option} and '
                          f'self.max_option: {self.max_option}')
             return {}
+        option_id = options[random.choice(indices)]['id']
         logger.debug("poll %s selected option_id=%s", poll_id, option_id)
-        r = self.session.post(
+        r = self._csrf_post(
             endpoints['respond_to_poll'].format(uid=poll_id),
-            headers={'x-csrf-token': self._get_csrf_token()},
-            data={'option_id': option_id, 'isPending': True, 'source': "pollev_page"}
+            # requests sent True as 'True'; httpx would send 'true', so keep it explicit.
+            data={'option_id': option_id, 'isPending': 'True', 'source': "pollev_page"}
         )
         logger.debug("poll %s respond status=%s body=%s",
-                     poll_id, r.status_code, r.text[:512])
-        return r.json()
+                     poll_id, r.status_code, r.content[:512].decode('utf-8', 'replace'))
+        if not r.is_success:
+            # The cached options may be stale; fetch them again next time.
+            self._poll_cache.pop(poll_id, None)
+        if r.status_code in CSRF_REJECTED_STATUSES:
+            logger.error("Could not answer poll %s: response rejected (status=%s).",
+                         poll_id, r.status_code)
+            return {}
+        try:
+            return orjson.loads(r.content)
+        except orjson.JSONDecodeError:
+            logger.error("Could not answer poll %s: response was not JSON (status=%s).",
+                         poll_id, r.status_code)
+            return {}
 
     def alive(self):
         return time.time() <= self.start_time + self.lifetime
@@ -301,23 +504,23 @@ class PollBot:
             else:
                 self.login()
 
-            referer = endpoints['home'].format(host=self.host)
+            referer = self._home_url
             self.session.headers['Referer'] = referer
             try:
                 logger.debug("warming up session via %s", referer)
-                self.session.get(referer, timeout=5)
+                # Only the Set-Cookie headers matter here, so skip the page body.
+                r = self.session.head(referer, timeout=5)
+                if r.status_code == 405:
+                    # HEAD not allowed; open a GET and close it without reading the body.
+                    with self.session.stream('GET', referer, timeout=5):
+                        pass
             except Exception as exc:
                 logger.debug("host warm-up failed (non-fatal): %s", exc)
 
             registration_url = f"https://pollev.com/proxy/api/users/{self.host}/participant_registration"
             try:
                 logger.debug("attempting participant registration → %s", registration_url)
-                self.session.post(
-                    registration_url,
-                    headers={'x-csrf-token': self._get_csrf_token()},
-                    json={},
-                    timeout=5
-                )
+                self._csrf_post(registration_url, json={}, timeout=5)
             except Exception as exc:
                 logger.debug("participant_registration failed or unavailable: %s", exc)
 
@@ -334,7 +537,10 @@ class PollBot:
                 )
                 return
             self.firehose_token = token
-            self.last_message_sequence = 0
+            self._firehose_url_fmt = _partial_format(endpoints['firehose_with_token'],
+                                                     host=self.host, token=token)
+            self.last_message_sequence = self.initial_sequence
+            self._handled_sequence = self.initial_sequence
         except (LoginError, ValueError) as e:
             logger.error(e)
             return
@@ -344,15 +550,19 @@ class PollBot:
 
             if poll_id is None:
                 logger.info(f'`{self.host}` has no new activity yet. Polling again shortly.')
-                sleep_for = min(1.0, self.closed_wait)
-                if sleep_for > 0:
-                    logger.debug("sleeping for %s seconds before next firehose check", sleep_for)
-                    time.sleep(sleep_for)
+                if self._backoff > 0:
+                    logger.debug("sleeping for %s seconds before next firehose check", self._backoff)
+                    time.sleep(self._backoff)
+                self._backoff = min(MAX_IDLE_BACKOFF, self.closed_wait,
+                                    max(0.05, self._backoff * 2))
+                self._mark_sequence_handled()
             else:
+                self._backoff = 0.0
                 logger.info(f"{self.host} has opened a new poll! "
                             f"Waiting {self.open_wait} seconds before responding.")
                 time.sleep(self.open_wait)
                 r = self.answer_poll(poll_id)
+                self._mark_sequence_handled()
                 if not r:
                     logger.warning("poll %s response payload empty; request likely failed", poll_id)
                 logger.info(f'Received response: {r}')